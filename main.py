@@ -1,9 +1,15 @@
-from fastapi import FastAPI, UploadFile, File, Form, HTTPException
+import os
+import re
+import uuid
+from fastapi import FastAPI, UploadFile, File, Form, HTTPException, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse
 from services.llm_query_parser.llm_query_parser import QueryRequest, generate_pandas_code
 from services.llm_query_parser import llm_query_parser
 from services.code_sandbox_mcp.main import run_code_in_sandbox
 from services.llm_answer_generator.llm_answer_generator import AnswerRequest, generate_answer
 from services.session_manager import session_manager
+from services.stats_catalog.stats_catalog import answer_from_catalog, prune_row_groups, row_ranges, write_pruned_csv
 
 app = FastAPI(title="Simple Data Agent System")
 
@@ -13,39 +19,210 @@ PROFILE_CODE = (
     "print(list(df.columns))\n"
 )
 
+# Resource failures are reported as-is instead of re-running the profile code
+STRUCTURED_ERRORS = ("oom", "timeout", "admission_rejected", "sandbox_image_missing")
+
+async def run_and_collect(pandas_code: str, file_path: str, intermediates: list = None, result_path: str = None,
+                          ranges: list = None, scale_factor: float = None):
+    # Run code in Docker off the event loop so admission waits don't block other requests;
+    # fall back to the profile code on error or empty output.
+    # Returns (output, structured error, metadata of the result captured at result_path)
+    result = await run_in_threadpool(
+        run_code_in_sandbox, pandas_code, file_path=file_path,
+        intermediates=intermediates, result_path=result_path, row_ranges=ranges, scale_factor=scale_factor
+    )
+    output = (result["stdout"] or "") + ("\n" + result["stderr"] if result["stderr"] else "")
+    if result.get("error") in STRUCTURED_ERRORS:
+        return output, result["error"], None
+    error_triggers = ["not found", "KeyError", "EmptyDataError", "No columns to parse", "not in index"]
+    if (not result["success"]) or any(trigger.lower() in output.lower() for trigger in error_triggers) or not result["stdout"].strip():
+        summary_result = await run_in_threadpool(run_code_in_sandbox, PROFILE_CODE, file_path=file_path)
+        output = (summary_result["stdout"] or "") + ("\n" + summary_result["stderr"] if summary_result["stderr"] else "")
+        return output, None, None
+    return output, None, result.get("result")
+
+def describe_intermediates(intermediates: list):
+    # One line per prev_N variable for the query parser prompt
+    lines = []
+    for i, intermediate in enumerate(intermediates):
+        kind = "Series" if intermediate["kind"] == "series" else "DataFrame"
+        latest = " (most recent)" if i == len(intermediates) - 1 else ""
+        lines.append(
+            f"- {intermediate['name']}{latest}: {kind} with {intermediate['rows']} rows, "
+            f"columns {intermediate['columns']}, from question: {intermediate['query']!r}"
+        )
+    return "\n".join(lines)
+
+def materialize(session_id: str, query: str, pandas_code: str, result_path: str, result_meta: dict):
+    # Keep the captured result as the next prev_N intermediate, or drop the unused path
+    if result_meta:
+        return session_manager.save_intermediate(session_id, result_path, result_meta, query, pandas_code)
+    if os.path.exists(result_path):
+        os.remove(result_path)
+    session_manager.append_history(session_id, {"query": query, "code": pandas_code, "intermediate": None})
+    return None
+
+def prune_dataset(session_id: str, pandas_code: str, file_path: str):
+    # Filtered snippets only need the row groups whose zone maps can match the filter.
+    # Returns the file to run on and the original row numbers it covers (None for the full file)
+    catalog = session_manager.get_catalog(session_id)
+    row_groups = prune_row_groups(pandas_code, catalog)
+    if row_groups is None:
+        return file_path, None
+    pruned_path = write_pruned_csv(file_path, catalog, row_groups, session_manager.new_pruned_path(session_id))
+    return pruned_path, row_ranges(catalog, row_groups)
+
+def sandbox_failure(error: str, pandas_code: str, output: str):
+    # Structured failure response for OOM kills, timeouts, admission rejections and a missing
+    # sandbox image; the last two are server-side, not a problem with the question
+    status_code = 503 if error in ("admission_rejected", "sandbox_image_missing") else 422
+    return JSONResponse(status_code=status_code, content={
+        "error": error,
+        "pandas_code": pandas_code,
+        "sandbox_output": output
+    })
+
+async def run_exact(session_id: str, job_id: str, query: str, schema: str, pandas_code: str, file_path: str, intermediates: list):
+    # Background full-dataset run that replaces a preview answer
+    try:
+        result = await exact_result(session_id, query, schema, pandas_code, file_path, intermediates)
+    except Exception as e:
+        # Never leave the job "running" (e.g. when the answer LLM returns an HTTP error)
+        result = {"status": "failed", "approximate": False, "error": str(e), "pandas_code": pandas_code}
+    session_manager.save_result(session_id, job_id, result)
+
+async def exact_result(session_id: str, query: str, schema: str, pandas_code: str, file_path: str, intermediates: list):
+    result_path = session_manager.new_intermediate_path(session_id)
+    run_path, ranges = prune_dataset(session_id, pandas_code, file_path)
+    try:
+        output, error, result_meta = await run_and_collect(pandas_code, run_path, intermediates, result_path, ranges)
+    finally:
+        if run_path != file_path:
+            os.remove(run_path)
+    intermediate = materialize(session_id, query, pandas_code, result_path, result_meta)
+    if error:
+        return {
+            "status": "failed",
+            "approximate": False,
+            "error": error,
+            "pandas_code": pandas_code,
+            "sandbox_output": output
+        }
+    summary = await generate_answer(AnswerRequest(query=query, data_preview=output, columns=schema, code=pandas_code))
+    return {
+        "status": "done",
+        "approximate": False,
+        "error": None,
+        "answer": summary.answer,
+        "pandas_code": pandas_code,
+        "sandbox_output": output,
+        "intermediate": intermediate
+    }
+
 @app.post("/ask")
-async def ask(session_id: str = Form(...), query: str = Form(...)):
+async def ask(background_tasks: BackgroundTasks, session_id: str = Form(...), query: str = Form(...), mode: str = Form("exact")):
+    if mode not in ("exact", "preview"):
+        raise HTTPException(status_code=400, detail="mode must be 'exact' or 'preview'")
     # 1. Get file and profile (columns) from session
     file_path = session_manager.get_file(session_id)
     schema = session_manager.get_profile(session_id)
-    # 2. LLM generates code using schema (column names)
-    pandas_code_obj = await generate_pandas_code(QueryRequest(query=query, schema=schema))
+    sample = session_manager.get_sample(session_id)
+    intermediates = list(session_manager.get_intermediates(session_id))
+    # 2. LLM generates code using schema (column names) and earlier results (prev_N)
+    context = describe_intermediates(intermediates) if intermediates else None
+    pandas_code_obj = await generate_pandas_code(QueryRequest(query=query, schema=schema, context=context))
     pandas_code = pandas_code_obj.pandas_code if hasattr(pandas_code_obj, 'pandas_code') else pandas_code_obj['pandas_code']
-    # 3. Run code in Docker using saved file
-    result = run_code_in_sandbox(pandas_code, file_path=file_path)
-    output = (result["stdout"] or "") + ("\n" + result["stderr"] if result["stderr"] else "")
-    # 4. If error or not found, run summary/profile code
-    error_triggers = ["not found", "KeyError", "EmptyDataError", "No columns to parse", "not in index"]
-    if (not result["success"]) or any(trigger.lower() in output.lower() for trigger in error_triggers) or not result["stdout"].strip():
-        summary_result = run_code_in_sandbox(PROFILE_CODE, file_path=file_path)
-        output = (summary_result["stdout"] or "") + ("\n" + summary_result["stderr"] if summary_result["stderr"] else "")
-    # 5. Summarize the output using the LLM answer agent
+    # 2b. Plain column aggregates are answered from the upload-time statistics catalog
+    catalog_output = answer_from_catalog(pandas_code, session_manager.get_catalog(session_id))
+    if catalog_output is not None:
+        session_manager.append_history(session_id, {"query": query, "code": pandas_code, "intermediate": None})
+        summary = await generate_answer(AnswerRequest(query=query, data_preview=catalog_output, columns=schema, code=pandas_code))
+        return {
+            "answer": summary.answer,
+            "pandas_code": pandas_code,
+            "sandbox_output": catalog_output,
+            "approximate": False,
+            "intermediate": None,
+            "source": "catalog"
+        }
+    # prev_N were computed on the full dataset, so follow-ups built on them skip the sample
+    uses_intermediates = any(re.search(rf"\b{i['name']}\b", pandas_code) for i in intermediates)
+    if mode == "preview" and sample and sample["file_path"] != file_path and not uses_intermediates:
+        # 3a. Run against the upload-time sample, with counts and sums scaled up in the script;
+        #     the exact run continues in the background
+        scale_factor = sample["total_rows"] / sample["rows"]
+        output, error, _ = await run_and_collect(pandas_code, sample["file_path"], scale_factor=scale_factor)
+        if error:
+            return sandbox_failure(error, pandas_code, output)
+        data_preview = (
+            output
+            + f"\n\nNOTE: this output is an estimate from a random sample of {sample['rows']} of "
+            f"{sample['total_rows']} rows. State that the answer is approximate."
+        )
+        summary = await generate_answer(AnswerRequest(query=query, data_preview=data_preview, columns=schema, code=pandas_code))
+        job_id = str(uuid.uuid4())
+        session_manager.save_result(session_id, job_id, {"status": "running"})
+        background_tasks.add_task(run_exact, session_id, job_id, query, schema, pandas_code, file_path, intermediates)
+        return {
+            "answer": summary.answer,
+            "pandas_code": pandas_code,
+            "sandbox_output": output,
+            "approximate": True,
+            "scale_factor": scale_factor,
+            "job_id": job_id
+        }
+    # 3. Run code in Docker using saved file, restricted to matching row groups for filtered
+    #    snippets (falls back to profile output on error)
+    result_path = session_manager.new_intermediate_path(session_id)
+    run_path, ranges = prune_dataset(session_id, pandas_code, file_path)
+    try:
+        output, error, result_meta = await run_and_collect(pandas_code, run_path, intermediates, result_path, ranges)
+    finally:
+        if run_path != file_path:
+            os.remove(run_path)
+    intermediate = materialize(session_id, query, pandas_code, result_path, result_meta)
+    if error:
+        return sandbox_failure(error, pandas_code, output)
+    # 4. Summarize the output using the LLM answer agent
     summary = await generate_answer(AnswerRequest(query=query, data_preview=output, columns=schema, code=pandas_code))
     return {
         "answer": summary.answer,
         "pandas_code": pandas_code,
-        "sandbox_output": output
+        "sandbox_output": output,
+        "approximate": False,
+        "intermediate": intermediate
     }
 
+@app.get("/ask/result")
+async def ask_result(session_id: str, job_id: str):
+    # Poll for the exact answer that replaces a preview
+    result = session_manager.get_result(session_id, job_id)
+    if result is None:
+        raise HTTPException(status_code=404, detail="Unknown job_id")
+    return result
+
+@app.get("/history")
+async def history(session_id: str):
+    # Past questions with their code and the prev_N intermediate they produced (if still kept)
+    kept = {i["name"] for i in session_manager.get_intermediates(session_id)}
+    return [
+        {**entry, "intermediate": entry["intermediate"] if entry["intermediate"] in kept else None}
+        for entry in session_manager.get_history(session_id)
+    ]
+
 @app.post("/upload")
 async def upload(file: UploadFile = File(...)):
     # Create a session and save the uploaded file
     session_id = session_manager.create_session()
     session_manager.save_file(session_id, file)
     file_path = session_manager.get_file(session_id)
+    # Build the preview sample and the column statistics catalog in one pass, off the event loop
+    await run_in_threadpool(session_manager.ingest_file, session_id)
     # Run the profile code (only column names)
-    result = run_code_in_sandbox(PROFILE_CODE, file_path=file_path)
+    result = await run_in_threadpool(run_code_in_sandbox, PROFILE_CODE, file_path=file_path)
     output = (result["stdout"] or "") + ("\n" + result["stderr"] if result["stderr"] else "")
+    if result.get("error") in STRUCTURED_ERRORS:
+        return sandbox_failure(result["error"], PROFILE_CODE, output)
     session_manager.save_profile(session_id, output)
     return {
         "session_id": session_id,
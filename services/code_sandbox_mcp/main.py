@@ -6,8 +6,14 @@ import os
 import subprocess
 import uuid
 import time
-from typing import Optional
+import threading
+from collections import deque
+import ast
+import json
+import re
+from typing import List, Optional
 from services.session_manager.session_manager import get_docker_state, save_docker_state, clear_docker_state
+from services.stats_catalog.stats_catalog import restore_index_code
 
 app = FastAPI(title="Code Sandbox MCP Server")
 
@@ -15,9 +21,79 @@ class ExecutionResult(BaseModel):
     stdout: str
     stderr: str
     success: bool
+    error: Optional[str] = None  # "oom", "timeout", "admission_rejected" or "sandbox_image_missing"
+    resource_profile: Optional[str] = None
 
-DOCKER_IMAGE = "python:3.11-slim"
-REQUIRED_PACKAGES = "pandas"
+# Image with pandas preinstalled so runs can use --network none. Build it once with
+#   docker build -f Dockerfile.sandbox -t data-agent-sandbox .
+# or point SANDBOX_IMAGE at another image that has the REQUIRED_PACKAGES installed.
+DOCKER_IMAGE = os.getenv("SANDBOX_IMAGE", "data-agent-sandbox")
+REQUIRED_PACKAGES = ["pandas", "pyarrow"]
+SANDBOX_NETWORK = os.getenv("SANDBOX_NETWORK", "none")
+
+# Per-execution resource tiers, picked from dataset size and code cost
+RESOURCE_PROFILES = {
+    "small": {"memory_mb": 512, "cpus": 1.0, "pids": 64, "timeout": 60},
+    "medium": {"memory_mb": 2048, "cpus": 2.0, "pids": 128, "timeout": 180},
+    "large": {"memory_mb": 8192, "cpus": 4.0, "pids": 256, "timeout": 600},
+}
+# pandas typically needs several times the CSV size in memory; wide operations need more
+MEMORY_PER_CSV_BYTE = 5
+HEAVY_OPERATIONS = ["groupby", "merge", "join", "pivot", "crosstab", "sort_values", "apply", "explode", "rolling"]
+OOM_EXIT_CODE = 137
+# docker run exits with 125 when it cannot start the container, e.g. the image was never built
+DOCKER_RUN_FAILED = 125
+IMAGE_MISSING_MARKERS = ["Unable to find image", "pull access denied", "No such image", "repository does not exist"]
+
+def _default_memory_budget_mb() -> int:
+    try:
+        total = os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+        return int(total * 0.75 / (1024 * 1024))
+    except (ValueError, OSError, AttributeError):
+        return 8192
+
+# Admission control: total memory committed to running sandboxes may not exceed the budget.
+# The counter is per process, so with several API workers each one admits up to the full
+# budget; set SANDBOX_MEMORY_BUDGET_MB to the host budget divided by the worker count.
+HOST_MEMORY_BUDGET_MB = int(os.getenv("SANDBOX_MEMORY_BUDGET_MB", _default_memory_budget_mb()))
+ADMISSION_TIMEOUT = float(os.getenv("SANDBOX_ADMISSION_TIMEOUT", 30))
+# Waiters are admitted first come, first served: a run that fits is not let past an earlier
+# waiter that is still waiting for memory, so large runs are not starved by a stream of small ones.
+_committed_memory_mb = 0
+_admission = threading.Condition()
+_admission_queue = deque()
+
+def choose_resource_profile(file_size: int, code: str) -> str:
+    estimated_mb = file_size * MEMORY_PER_CSV_BYTE / (1024 * 1024)
+    heavy = sum(1 for op in HEAVY_OPERATIONS if op in code)
+    estimated_mb *= 1 + heavy
+    for name, profile in RESOURCE_PROFILES.items():
+        if estimated_mb <= profile["memory_mb"] * 0.8:
+            return name
+    return "large"
+
+def acquire_memory(memory_mb: int, timeout: float = ADMISSION_TIMEOUT) -> bool:
+    global _committed_memory_mb
+    ticket = object()
+    with _admission:
+        _admission_queue.append(ticket)
+        admitted = _admission.wait_for(
+            lambda: _admission_queue[0] is ticket
+            and _committed_memory_mb + memory_mb <= HOST_MEMORY_BUDGET_MB,
+            timeout=timeout
+        )
+        _admission_queue.remove(ticket)
+        if admitted:
+            _committed_memory_mb += memory_mb
+        # The next waiter may now be at the head of the queue (or fit after a timed-out one left)
+        _admission.notify_all()
+        return admitted
+
+def release_memory(memory_mb: int):
+    global _committed_memory_mb
+    with _admission:
+        _committed_memory_mb -= memory_mb
+        _admission.notify_all()
 
 # Persistent Docker management
 import docker
@@ -65,16 +141,150 @@ def stop_persistent_container(session_id: str):
 PROFILE_CODE = """
 import pandas as pd\ndf = pd.read_csv('input.csv')\nprint(list(df.columns))\n"""
 
+# Query scripts keep the last DataFrame/Series assigned to a variable as an intermediate,
+# falling back to the last one printed when nothing was assigned
+CAPTURE_PREAMBLE = """
+import builtins
+_last_result = None
+def print(*args, **kwargs):
+    global _last_result
+    for arg in args:
+        if isinstance(arg, (pd.DataFrame, pd.Series)):
+            _last_result = arg
+    builtins.print(*args, **kwargs)
+"""
+
+CAPTURE_EPILOGUE = """
+_result = None
+for _name in reversed(_assigned):
+    if isinstance(globals().get(_name), (pd.DataFrame, pd.Series)):
+        _result = globals()[_name]
+        break
+if _result is None and _capture_printed:
+    _result = _last_result
+if _result is not None:
+    try:
+        import json as _json
+        _kind = 'series' if isinstance(_result, pd.Series) else 'frame'
+        _frame = _result.to_frame() if _kind == 'series' else _result.copy()
+        _frame.columns = [str(c) for c in _frame.columns]
+        _frame.to_parquet('result.parquet')
+        with open('result.json', 'w') as _f:
+            _json.dump({'kind': _kind, 'columns': list(_frame.columns), 'rows': len(_frame)}, _f)
+    except Exception:
+        pass
+"""
+
+# Printed previews of a result are not the result itself
+PREVIEW_METHODS = ("head", "tail", "sample")
+
+def capture_plan(code: str):
+    """Variables the code assigns (in source order) and whether printed objects may be kept."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return [], False
+    assigned = []
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Assign):
+            targets = node.targets
+        elif isinstance(node, (ast.AnnAssign, ast.AugAssign)):
+            targets = [node.target]
+        else:
+            continue
+        for target in targets:
+            names = target.elts if isinstance(target, ast.Tuple) else [target]
+            for name in names:
+                # df is the full dataset, prev_N are already kept
+                if isinstance(name, ast.Name) and name.id != "df" and not re.fullmatch(r"prev_\d+", name.id):
+                    assigned.append((node.lineno, name.id))
+    capture_printed = not any(
+        isinstance(node, ast.Call) and isinstance(node.func, ast.Name) and node.func.id == "print"
+        and any(isinstance(arg, ast.Call) and isinstance(arg.func, ast.Attribute)
+                and arg.func.attr in PREVIEW_METHODS for arg in node.args)
+        for node in ast.walk(tree)
+    )
+    return [name for _, name in sorted(assigned, key=lambda item: item[0])], capture_printed
+
+# Preview runs on a sample: counts and sums are scaled to the full dataset in the script itself
+SCALE_PREAMBLE = """
+import numbers as _numbers
+def _scale_series(s):
+    if pd.api.types.is_bool_dtype(s) or not pd.api.types.is_numeric_dtype(s):
+        return s
+    if pd.api.types.is_integer_dtype(s):
+        return (s * _SCALE).round().astype(s.dtype)
+    return s * _SCALE
+def _scale(value):
+    if isinstance(value, bool):
+        return value
+    if isinstance(value, _numbers.Integral):
+        return int(round(value * _SCALE))
+    if isinstance(value, _numbers.Real):
+        return value * _SCALE
+    if isinstance(value, pd.Series):
+        return _scale_series(value)
+    if isinstance(value, pd.DataFrame):
+        return value.apply(_scale_series)
+    return value
+"""
+
+SCALED_METHODS = ("sum", "count", "size", "value_counts")
+
+def _calls_scale(node) -> bool:
+    return any(
+        isinstance(n, ast.Call) and isinstance(n.func, ast.Name) and n.func.id == "_scale"
+        for n in ast.walk(node)
+    )
+
+class _ScaleAggregates(ast.NodeTransformer):
+    # Wraps len(x), x.shape[0] and x.sum()/count()/size()/value_counts() in _scale(...),
+    # unless the operand is already scaled (e.g. df.count().sum() or len(s.value_counts()))
+    def _wrap(self, node):
+        return ast.copy_location(ast.Call(func=ast.Name(id="_scale", ctx=ast.Load()), args=[node], keywords=[]), node)
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        func = node.func
+        if isinstance(func, ast.Name) and func.id == "len" and len(node.args) == 1:
+            return node if _calls_scale(node.args[0]) else self._wrap(node)
+        if isinstance(func, ast.Attribute) and func.attr in SCALED_METHODS:
+            if any(keyword.arg == "normalize" for keyword in node.keywords) or _calls_scale(func.value):
+                return node
+            return self._wrap(node)
+        return node
+
+    def visit_Subscript(self, node):
+        self.generic_visit(node)
+        index = node.slice.value if isinstance(node.slice, getattr(ast, "Index", ())) else node.slice
+        if (isinstance(node.value, ast.Attribute) and node.value.attr == "shape"
+                and isinstance(index, ast.Constant) and index.value == 0 and not _calls_scale(node.value)):
+            return self._wrap(node)
+        return node
+
+def scale_aggregates(code: str) -> str:
+    """Rewrite query code so counts and sums computed on a sample estimate full-dataset values."""
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return code
+    return ast.unparse(ast.fix_missing_locations(_ScaleAggregates().visit(tree)))
+
 def extract_columns_in_sandbox(file: UploadFile = None, file_path: str = None):
     return run_code_in_sandbox(PROFILE_CODE, file, file_path, mode="profile")
 
-def run_code_in_sandbox(code: str, file: UploadFile = None, file_path: str = None, mode: str = "query"):
+def run_code_in_sandbox(code: str, file: UploadFile = None, file_path: str = None, mode: str = "query",
+                        intermediates: Optional[List[dict]] = None, result_path: Optional[str] = None,
+                        row_ranges: Optional[List[List[int]]] = None, scale_factor: Optional[float] = None):
     import shutil
     import tempfile
     import os
     import subprocess
     import sys
     tempdir = tempfile.mkdtemp()
+    profile_name = None
+    memory_mb = 0
+    container_name = f"sandbox-{uuid.uuid4().hex[:12]}"
     try:
         # Save uploaded CSV as input.csv
         csv_path = os.path.join(tempdir, "input.csv")
@@ -86,12 +296,22 @@ def run_code_in_sandbox(code: str, file: UploadFile = None, file_path: str = Non
         # Debug: print file and script contents
         if not os.path.exists(csv_path):
             print(f"[ERROR] input.csv not found at {csv_path}")
+            file_size = 0
         else:
             file_size = os.path.getsize(csv_path)
             print(f"[DEBUG] input.csv size: {file_size} bytes at {csv_path}")
             if file_size == 0:
                 print("[ERROR] input.csv is empty!")
                 return {"stdout": "", "stderr": "input.csv is empty!", "success": False}
+        # Copy in only the prev_N results the code refers to
+        # (skipping any evicted since the caller listed them)
+        intermediates = [
+            i for i in intermediates or []
+            if re.search(rf"\b{i['name']}\b", code) and os.path.exists(i["path"])
+        ]
+        for intermediate in intermediates:
+            shutil.copy(intermediate["path"], os.path.join(tempdir, f"{intermediate['name']}.parquet"))
+            file_size += os.path.getsize(intermediate["path"])
         # Write the code to script.py
         code_path = os.path.join(tempdir, "script.py")
         with open(code_path, 'w', encoding='utf-8') as f:
@@ -100,7 +320,24 @@ def run_code_in_sandbox(code: str, file: UploadFile = None, file_path: str = Non
             else:
                 f.write("import pandas as pd\n")
                 f.write("df = pd.read_csv('input.csv')\n")
+                if row_ranges:
+                    # input.csv holds only some row groups; keep the full file's row labels
+                    f.write(restore_index_code(row_ranges))
+                for intermediate in intermediates:
+                    name = intermediate["name"]
+                    squeeze = ".iloc[:, 0]" if intermediate["kind"] == "series" else ""
+                    f.write(f"{name} = pd.read_parquet('{name}.parquet'){squeeze}\n")
+                if scale_factor:
+                    # input.csv is a sample; scale counts and sums up to the full dataset
+                    f.write(f"_SCALE = {scale_factor!r}\n" + SCALE_PREAMBLE)
+                    code = scale_aggregates(code)
+                if result_path:
+                    f.write(CAPTURE_PREAMBLE)
                 f.write(code)
+                if result_path:
+                    assigned, capture_printed = capture_plan(code)
+                    f.write(f"\n_assigned = {assigned!r}\n_capture_printed = {capture_printed!r}\n")
+                    f.write(CAPTURE_EPILOGUE)
         with open(code_path, 'r', encoding='utf-8') as f:
             print(f"[DEBUG] script.py contents:\n{f.read()}")
         # Convert tempdir to Docker-compatible path if on Windows
@@ -110,34 +347,96 @@ def run_code_in_sandbox(code: str, file: UploadFile = None, file_path: str = Non
             if ":" in mount_dir:
                 drive, rest = mount_dir.split(":", 1)
                 mount_dir = f"/{drive.lower()}{rest}"
+        # Pick a resource tier and wait for room under the host memory budget
+        profile_name = choose_resource_profile(file_size, code)
+        profile = RESOURCE_PROFILES[profile_name]
+        # A tier larger than the whole budget is capped so it can still run on small hosts
+        limit_mb = min(profile["memory_mb"], HOST_MEMORY_BUDGET_MB)
+        if not acquire_memory(limit_mb):
+            print(f"[ERROR] Admission rejected for {profile_name} profile ({limit_mb} MB).")
+            return {
+                "stdout": "",
+                "stderr": f"Sandbox busy: no capacity for a {profile_name} execution ({limit_mb} MB).",
+                "success": False,
+                "error": "admission_rejected",
+                "resource_profile": profile_name
+            }
+        memory_mb = limit_mb
         # Build the docker run command
         docker_cmd = [
             "docker", "run", "--rm",
+            "--name", container_name,
+            "--memory", f"{limit_mb}m",
+            "--memory-swap", f"{limit_mb}m",
+            "--cpus", str(profile["cpus"]),
+            "--pids-limit", str(profile["pids"]),
+            "--network", SANDBOX_NETWORK,
             "-v", f"{mount_dir}:/sandbox",
             "-w", "/sandbox",
             DOCKER_IMAGE,
             "sh", "-c",
-            f"pip install {REQUIRED_PACKAGES} >/dev/null 2>&1 && python script.py"
+            f"python -c 'import {', '.join(REQUIRED_PACKAGES)}' 2>/dev/null || pip install {' '.join(REQUIRED_PACKAGES)} >/dev/null 2>&1; python script.py"
         ]
         print(f"[DEBUG] Running Docker command: {' '.join(docker_cmd)}")
-        result = subprocess.run(docker_cmd, capture_output=True, text=True, timeout=60)
+        result = subprocess.run(docker_cmd, capture_output=True, text=True, timeout=profile["timeout"])
         print(f"[DEBUG] STDOUT: {result.stdout}")
         print(f"[DEBUG] STDERR: {result.stderr}")
         print(f"[DEBUG] Return code: {result.returncode}")
+        if result.returncode == OOM_EXIT_CODE:
+            print(f"[ERROR] Execution killed after exceeding {limit_mb} MB.")
+            return {
+                "stdout": result.stdout,
+                "stderr": f"Execution exceeded the {profile_name} memory limit of {limit_mb} MB and was killed.",
+                "success": False,
+                "error": "oom",
+                "resource_profile": profile_name
+            }
+        if result.returncode == DOCKER_RUN_FAILED and any(marker in result.stderr for marker in IMAGE_MISSING_MARKERS):
+            print(f"[ERROR] Sandbox image {DOCKER_IMAGE} not found.")
+            return {
+                "stdout": "",
+                "stderr": (
+                    f"Sandbox image {DOCKER_IMAGE!r} not found. Build it with "
+                    f"'docker build -f Dockerfile.sandbox -t {DOCKER_IMAGE} .' or set SANDBOX_IMAGE."
+                ),
+                "success": False,
+                "error": "sandbox_image_missing",
+                "resource_profile": profile_name
+            }
         if result.returncode != 0:
             print(f"[ERROR] Docker run failed. Check input.csv and script.py above.")
+        # Keep the captured result before the tempdir is removed
+        result_meta = None
+        captured = os.path.join(tempdir, "result.parquet")
+        if result_path and result.returncode == 0 and os.path.exists(captured):
+            shutil.copy(captured, result_path)
+            with open(os.path.join(tempdir, "result.json"), encoding="utf-8") as f:
+                result_meta = json.load(f)
         return {
             "stdout": result.stdout,
             "stderr": result.stderr,
-            "success": result.returncode == 0
+            "success": result.returncode == 0,
+            "error": None,
+            "resource_profile": profile_name,
+            "result": result_meta
         }
     except subprocess.TimeoutExpired:
         print("[ERROR] Execution timed out.")
-        return {"stdout": "", "stderr": "Execution timed out.", "success": False}
+        # subprocess only kills the docker client; stop the container as well
+        subprocess.run(["docker", "kill", container_name], capture_output=True)
+        return {
+            "stdout": "",
+            "stderr": f"Execution timed out after {RESOURCE_PROFILES[profile_name]['timeout']} seconds.",
+            "success": False,
+            "error": "timeout",
+            "resource_profile": profile_name
+        }
     except Exception as e:
         print(f"[ERROR] Exception: {e}")
         return {"stdout": "", "stderr": str(e), "success": False}
     finally:
+        if memory_mb:
+            release_memory(memory_mb)
         shutil.rmtree(tempdir, ignore_errors=True)
 
 @app.post("/execute", response_model=ExecutionResult)
@@ -152,5 +451,7 @@ async def execute_code(
     return ExecutionResult(
         stdout=result["stdout"],
         stderr=result["stderr"],
-        success=result["success"]
+        success=result["success"],
+        error=result.get("error"),
+        resource_profile=result.get("resource_profile")
     )
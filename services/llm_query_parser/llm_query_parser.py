@@ -13,11 +13,12 @@ OLLAMA_MODEL = "granite3.3:8b"  # or another model you have installed in Ollama
 class QueryRequest(BaseModel):
     query: str
     schema: str = None  # Optional: pass a string describing the dataframe schema
+    context: str = None  # Optional: previous results (prev_N variables) available to follow-up code
 
 class QueryResponse(BaseModel):
     pandas_code: str
 
-async def call_ollama(query: str, schema: str = None) -> str:
+async def call_ollama(query: str, schema: str = None, context: str = None) -> str:
     prompt = '''You are an intelligent, chain-of-thought driven Python Pandas code generator designed to transform a user's natural language query about a Pandas DataFrame into a single, correct, and fully executable Pandas code snippet.You make sure only provide the python code underneath the code section and nothing else at all otherwise the code might show error , since ur code would be directly used for running without any human intervention so there is no room for syntax errors or indention errors.
 
 ---
@@ -143,6 +144,12 @@ except Exception as e:
 '''
     if schema:
         prompt += f"\nDataFrame columns: {schema}\n"
+    if context:
+        prompt += (
+            "\nResults of earlier questions are pre-loaded as variables. For follow-up questions "
+            "(e.g. 'now only for 2023', 'break that down by region') start from the matching variable "
+            f"instead of re-filtering `df`:\n{context}\n"
+        )
     prompt += f"\nUser question: {query}\nCODE:"
     prompt = prompt.rstrip("\n") + "\n\n---\n\nCRITICAL OUTPUT INSTRUCTION:\n1. Put all your chain-of-thought reasoning BEFORE the 'CODE:' section.\n2. The 'CODE:' section MUST BE THE LAST THING IN YOUR RESPONSE.\n3. STOP COMPLETELY after writing the code.\n4. NO explanation, reasoning, comments, or ANY text after the code.\n5. NEVER write words like 'Reasoning', 'Explanation', 'Notes', etc. after the code.\n\nVIOLATION OF THESE INSTRUCTIONS WILL CAUSE SYSTEM FAILURE.\n"
 
@@ -193,7 +200,7 @@ except Exception as e:
             raise HTTPException(status_code=500, detail="Failed to parse LLM response.")
 
 async def generate_pandas_code(request: QueryRequest):
-    code = await call_ollama(request.query, request.schema)
+    code = await call_ollama(request.query, request.schema, request.context)
     return QueryResponse(pandas_code=code)
 
 @router.post("/parse", response_model=QueryResponse)
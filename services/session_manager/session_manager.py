@@ -2,7 +2,15 @@ import uuid
 import tempfile
 import shutil
 import os
+import csv
+import random
 from typing import Dict
+from services.stats_catalog.stats_catalog import build_catalog
+
+# Rows kept in the preview sample built at upload time
+SAMPLE_SIZE = 100_000
+# Bytes of materialized intermediates (prev_N results) kept per session
+INTERMEDIATE_BUDGET_BYTES = int(os.getenv("INTERMEDIATE_BUDGET_BYTES", 256 * 1024 * 1024))
 
 # In-memory session store (for demo; use Redis/DB for production)
 sessions: Dict[str, dict] = {}
@@ -24,6 +32,55 @@ def save_file(session_id: str, file):
 def get_file(session_id: str):
     return sessions[session_id].get("file_path")
 
+def ingest_file(session_id: str, sample_size: int = SAMPLE_SIZE):
+    # The catalog's streaming pass over the upload also fills a reservoir sample,
+    # so preview queries never have to load the full file.
+    file_path = sessions[session_id]["file_path"]
+    reservoir = []
+
+    def sample_row(row_number: int, row: list):
+        if row_number < sample_size:
+            reservoir.append((row_number, row))
+        else:
+            j = random.randint(0, row_number)
+            if j < sample_size:
+                reservoir[j] = (row_number, row)
+
+    catalog = save_catalog(session_id, on_row=sample_row)
+    total_rows = catalog["rows"]
+    if total_rows <= sample_size:
+        # Small file: the sample is the dataset itself
+        sample_path = file_path
+    else:
+        sample_path = os.path.join(os.path.dirname(file_path), "sample.csv")
+        reservoir.sort(key=lambda item: item[0])
+        with open(sample_path, "w", newline="", encoding="utf-8") as f:
+            writer = csv.writer(f)
+            writer.writerow(catalog["header"])
+            writer.writerows(row for _, row in reservoir)
+    sessions[session_id]["sample"] = {
+        "file_path": sample_path,
+        "rows": len(reservoir),
+        "total_rows": total_rows
+    }
+
+def get_sample(session_id: str):
+    return sessions[session_id].get("sample", None)
+
+def save_catalog(session_id: str, on_row=None):
+    # Scan the upload for the statistics catalog; on_row lets other ingest work share the pass
+    catalog = build_catalog(sessions[session_id]["file_path"], on_row=on_row)
+    sessions[session_id]["catalog"] = catalog
+    return catalog
+
+def get_catalog(session_id: str):
+    return sessions[session_id].get("catalog", None)
+
+def new_pruned_path(session_id: str):
+    # Unique CSV path for a copy of the dataset restricted to some row groups
+    session_dir = os.path.dirname(sessions[session_id]["file_path"])
+    return os.path.join(session_dir, f"pruned-{uuid.uuid4().hex}.csv")
+
 def save_profile(session_id: str, profile_output: str):
     sessions[session_id]["profile"] = profile_output
 
@@ -38,6 +95,54 @@ def append_history(session_id: str, entry: dict):
 def get_history(session_id: str):
     return sessions[session_id].get("history", [])
 
+def save_result(session_id: str, job_id: str, result: dict):
+    if "results" not in sessions[session_id]:
+        sessions[session_id]["results"] = {}
+    sessions[session_id]["results"][job_id] = result
+
+def get_result(session_id: str, job_id: str):
+    return sessions[session_id].get("results", {}).get(job_id, None)
+
+def new_intermediate_path(session_id: str):
+    # Unique parquet path next to the session's dataset for the sandbox to write into
+    session_dir = os.path.dirname(sessions[session_id]["file_path"])
+    return os.path.join(session_dir, f"result-{uuid.uuid4().hex}.parquet")
+
+def save_intermediate(session_id: str, path: str, meta: dict, query: str, code: str):
+    # Register a materialized result as prev_N, record it in history and enforce the byte budget
+    session = sessions[session_id]
+    session["intermediate_count"] = session.get("intermediate_count", 0) + 1
+    name = f"prev_{session['intermediate_count']}"
+    intermediate = {
+        "name": name,
+        "path": path,
+        "kind": meta.get("kind", "frame"),
+        "columns": meta.get("columns", []),
+        "rows": meta.get("rows", 0),
+        "bytes": os.path.getsize(path),
+        "query": query
+    }
+    if "intermediates" not in session:
+        session["intermediates"] = []
+    session["intermediates"].append(intermediate)
+    append_history(session_id, {"query": query, "code": code, "intermediate": name})
+    evict_intermediates(session_id, INTERMEDIATE_BUDGET_BYTES)
+    # A single result larger than the budget is evicted straight away
+    return name if intermediate in session["intermediates"] else None
+
+def evict_intermediates(session_id: str, budget: int = INTERMEDIATE_BUDGET_BYTES):
+    # Drop the oldest intermediates until the session fits its byte budget
+    intermediates = sessions[session_id].get("intermediates", [])
+    while intermediates and sum(i["bytes"] for i in intermediates) > budget:
+        evicted = intermediates.pop(0)
+        try:
+            os.remove(evicted["path"])
+        except OSError:
+            pass
+
+def get_intermediates(session_id: str):
+    return sessions[session_id].get("intermediates", [])
+
 def save_column_names(session_id: str, column_names: list):
     sessions[session_id]["column_names"] = column_names
 
@@ -0,0 +1,393 @@
+import ast
+import csv
+import math
+from typing import Callable, Dict, List, Optional
+
+try:
+    import pandas as pd
+except ImportError:  # without pandas, df.<name> column access is never trusted
+    pd = None
+
+# Rows per zone-map chunk ("row group") of the uploaded CSV
+ROW_GROUP_SIZE = 50_000
+# Distinct values tracked per column before the distinct count/top values become unknown
+DISTINCT_CAP = 10_000
+TOP_K = 10
+
+# Same strings pandas.read_csv treats as missing by default
+NA_VALUES = {
+    "", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN",
+    "<NA>", "N/A", "NA", "NULL", "NaN", "None", "n/a", "nan", "null"
+}
+
+AGGREGATES = ("max", "min", "mean", "sum", "count", "nunique")
+EXACT_INT_LIMIT = 2 ** 53
+
+def _parse_number(text: str):
+    if "_" in text:
+        return None
+    try:
+        return int(text)
+    except ValueError:
+        pass
+    try:
+        return float(text)
+    except ValueError:
+        return None
+
+# Strings pandas.read_csv turns into booleans when a column holds nothing else
+BOOL_VALUES = {"True", "TRUE", "true", "False", "FALSE", "false"}
+# pandas prints Series of up to this many rows in full (display.max_rows)
+MAX_PRINTED_ROWS = 60
+
+def _new_zone():
+    return {
+        "num_min": None, "num_max": None, "str_min": None, "str_max": None, "has_value": False,
+        "has_text": False, "has_nonbool_text": False, "has_number": False, "has_float": False, "has_null": False
+    }
+
+def _kind(zones: List[dict]) -> str:
+    # The dtype pandas.read_csv infers for a column made of these zones
+    if not any(zone["has_value"] for zone in zones):
+        return "empty"
+    has_null = any(zone["has_null"] for zone in zones)
+    if any(zone["has_text"] for zone in zones):
+        if has_null or any(zone["has_nonbool_text"] or zone["has_number"] for zone in zones):
+            return "text"
+        return "bool"
+    if has_null or any(zone["has_float"] for zone in zones):
+        return "float"
+    return "int"
+
+def _new_column():
+    return {"count": 0, "nulls": 0, "integral": True, "sum": 0, "values": {}, "overflow": False, "has_number": False}
+
+def _update(zone: dict, column: dict, text: str):
+    if text in NA_VALUES:
+        column["nulls"] += 1
+        zone["has_null"] = True
+        return
+    column["count"] += 1
+    zone["has_value"] = True
+    zone["str_min"] = text if zone["str_min"] is None else min(zone["str_min"], text)
+    zone["str_max"] = text if zone["str_max"] is None else max(zone["str_max"], text)
+    number = _parse_number(text)
+    if number is None:
+        zone["has_text"] = True
+        if text not in BOOL_VALUES:
+            zone["has_nonbool_text"] = True
+        key = text
+    else:
+        column["has_number"] = True
+        zone["has_number"] = True
+        if isinstance(number, float):
+            column["integral"] = False
+            zone["has_float"] = True
+        column["sum"] += number
+        zone["num_min"] = number if zone["num_min"] is None else min(zone["num_min"], number)
+        zone["num_max"] = number if zone["num_max"] is None else max(zone["num_max"], number)
+        key = number
+    if not column["overflow"]:
+        values = column["values"]
+        values[key] = values.get(key, 0) + 1
+        if len(values) > DISTINCT_CAP:
+            column["values"] = {}
+            column["overflow"] = True
+
+def _finalize(column: dict, zones: List[dict]):
+    numeric = not any(zone["has_text"] for zone in zones)
+    stats = {"numeric": numeric, "kind": _kind(zones), "count": column["count"], "nulls": column["nulls"]}
+    kept = [zone for zone in zones if zone["has_value"]]
+    if numeric and kept:
+        stats["min"] = min(zone["num_min"] for zone in kept)
+        stats["max"] = max(zone["num_max"] for zone in kept)
+        stats["sum"] = column["sum"]
+        stats["mean"] = column["sum"] / column["count"]
+        # pandas stores integer columns with missing values as float
+        stats["integral"] = stats["kind"] == "int"
+    elif kept:
+        stats["min"] = min(zone["str_min"] for zone in kept)
+        stats["max"] = max(zone["str_max"] for zone in kept)
+    # Text columns hold numeric-looking strings verbatim, so numeric keys are ambiguous there
+    if column["overflow"] or (not numeric and column["has_number"]):
+        stats["distinct"] = None
+        stats["top"] = None
+    else:
+        stats["distinct"] = len(column["values"])
+        ranked = sorted(column["values"].items(), key=lambda item: -item[1])
+        stats["top"] = [[value, count] for value, count in ranked[:TOP_K]]
+        stats["value_counts"] = [[value, count] for value, count in ranked]
+    return stats
+
+def _read_lines(f, position: list):
+    # Feed csv.reader line by line while tracking the byte offset consumed so far
+    for line in f:
+        position[0] += len(line)
+        yield line.decode("utf-8", errors="replace")
+
+def build_catalog(file_path: str, row_group_size: int = ROW_GROUP_SIZE, on_row: Optional[Callable] = None) -> Dict:
+    """Scan the CSV once and collect per-column aggregates, per-chunk zone maps and top values.
+
+    on_row(row_number, row) is called for every data row so other ingest work can share the pass.
+    """
+    position = [0]
+    with open(file_path, "rb") as f:
+        reader = csv.reader(_read_lines(f, position))
+        header = next(reader, None) or []
+        header_end = position[0]
+        columns = {name: _new_column() for name in header}
+        row_groups = []
+        group = None
+        rows = 0
+        for row in reader:
+            if not row:
+                # pandas skips blank lines
+                continue
+            if group is None:
+                group = {"offset": None, "start": rows, "rows": 0, "zones": {name: _new_zone() for name in header}}
+                group["offset"] = row_groups[-1]["end"] if row_groups else header_end
+            for i, name in enumerate(header):
+                _update(group["zones"][name], columns[name], row[i] if i < len(row) else "")
+            if on_row is not None:
+                on_row(rows, row)
+            group["rows"] += 1
+            rows += 1
+            if group["rows"] == row_group_size:
+                group["end"] = position[0]
+                row_groups.append(group)
+                group = None
+        if group is not None:
+            group["end"] = position[0]
+            row_groups.append(group)
+    stats = {
+        name: _finalize(column, [group["zones"][name] for group in row_groups])
+        for name, column in columns.items()
+    }
+    if len(set(header)) != len(header):
+        # pandas renames duplicate headers; keep only the row count for those files
+        stats, row_groups = {}, []
+    return {"rows": rows, "header": header, "header_end": header_end, "columns": stats, "row_groups": row_groups}
+
+# --- Planner -----------------------------------------------------------------
+
+def _slice_value(node):
+    # ast.Index wraps subscripts before Python 3.9
+    index = getattr(ast, "Index", None)
+    return node.value if index is not None and isinstance(node, index) else node
+
+def _constant(node):
+    node = _slice_value(node)
+    if isinstance(node, ast.Constant) and not isinstance(node.value, bool):
+        return node.value
+    if isinstance(node, ast.UnaryOp) and isinstance(node.op, ast.USub) and isinstance(node.operand, ast.Constant):
+        if isinstance(node.operand.value, (int, float)) and not isinstance(node.operand.value, bool):
+            return -node.operand.value
+    return None
+
+def _is_df(node):
+    return isinstance(node, ast.Name) and node.id == "df"
+
+def _column(node, catalog: Dict):
+    # df['col'] or df.col for a catalogued column
+    if isinstance(node, ast.Subscript) and _is_df(node.value):
+        name = _constant(node.slice)
+    elif isinstance(node, ast.Attribute) and _is_df(node.value):
+        # df.values, df.size, df.count, ... are DataFrame attributes, not columns
+        if pd is None or hasattr(pd.DataFrame, node.attr):
+            return None
+        name = node.attr
+    else:
+        return None
+    return name if isinstance(name, str) and name in catalog["columns"] else None
+
+def _statement(code: str):
+    try:
+        body = ast.parse(code).body
+    except SyntaxError:
+        return None
+    if len(body) == 1 and isinstance(body[0], ast.Try):
+        body = body[0].body
+    if len(body) != 1 or not isinstance(body[0], ast.Expr):
+        return None
+    call = body[0].value
+    if not (isinstance(call, ast.Call) and isinstance(call.func, ast.Name) and call.func.id == "print"):
+        return None
+    if len(call.args) != 1 or call.keywords:
+        return None
+    return call.args[0]
+
+def _format(value, stats: dict):
+    # Match pandas: int64 columns print as ints, float64 columns always with a decimal point
+    if stats["numeric"] and isinstance(value, (int, float)):
+        return str(int(value)) if stats["integral"] else str(float(value))
+    return str(value)
+
+def _format_value_counts(name: str, pairs: list, stats: dict):
+    # Same layout as print(series.value_counts()): left-aligned index, right-aligned counts
+    labels = [_format(value, stats) for value, _ in pairs]
+    counts = [str(count) for _, count in pairs]
+    label_width = max(len(label) for label in labels)
+    count_width = max(len(count) for count in counts)
+    lines = [name]
+    lines += [f"{label:<{label_width}}    {count:>{count_width}}" for label, count in zip(labels, counts)]
+    lines.append("Name: count, dtype: int64")
+    return "\n".join(lines)
+
+def answer_from_catalog(code: str, catalog: Optional[Dict]) -> Optional[str]:
+    """Return the printed output of a plain column aggregate snippet, or None if it needs a scan."""
+    if not catalog:
+        return None
+    expr = _statement(code)
+    if expr is None:
+        return None
+    # len(df) / df.shape[0]
+    if isinstance(expr, ast.Call) and isinstance(expr.func, ast.Name) and expr.func.id == "len":
+        if len(expr.args) == 1 and _is_df(expr.args[0]):
+            return str(catalog["rows"])
+        return None
+    if isinstance(expr, ast.Subscript) and isinstance(expr.value, ast.Attribute):
+        if _is_df(expr.value.value) and expr.value.attr == "shape" and _constant(expr.slice) == 0:
+            return str(catalog["rows"])
+        return None
+    if not (isinstance(expr, ast.Call) and isinstance(expr.func, ast.Attribute) and not expr.keywords):
+        return None
+    # df['col'].value_counts().head(n) / .nlargest(n)
+    limit = None
+    if expr.func.attr in ("head", "nlargest") and len(expr.args) == 1 and isinstance(_constant(expr.args[0]), int):
+        limit = _constant(expr.args[0])
+        inner = expr.func.value
+        if not (isinstance(inner, ast.Call) and isinstance(inner.func, ast.Attribute) and inner.func.attr == "value_counts"):
+            return None
+        expr = inner
+        if expr.keywords:
+            return None
+    if expr.args:
+        return None
+    name = _column(expr.func.value, catalog)
+    if name is None:
+        return None
+    stats = catalog["columns"][name]
+    agg = expr.func.attr
+    if stats["kind"] == "bool":
+        return None
+    if agg == "value_counts":
+        # Float labels get column-wide precision in pandas, and long results are truncated
+        if stats.get("value_counts") is None or stats["kind"] not in ("int", "text"):
+            return None
+        pairs = stats["value_counts"] if limit is None else stats["value_counts"][:limit]
+        if not pairs or len(pairs) > MAX_PRINTED_ROWS:
+            return None
+        return _format_value_counts(name, pairs, stats)
+    if limit is not None or agg not in AGGREGATES:
+        return None
+    if agg == "count":
+        return str(stats["count"])
+    if stats["kind"] == "float":
+        # float() and pandas' CSV parser/pairwise sums disagree in the last digits
+        return None
+    if agg == "nunique":
+        return None if stats["distinct"] is None else str(stats["distinct"])
+    if agg in ("sum", "mean") and not stats["numeric"]:
+        return None
+    if agg not in stats:
+        return None
+    if agg in ("sum", "mean") and abs(stats["sum"]) >= EXACT_INT_LIMIT:
+        # Beyond 2**53 pandas' float64 mean (and int64 sum) stop being exact
+        return None
+    if agg == "mean":
+        return str(float(stats["mean"]))
+    return _format(stats[agg], stats)
+
+def _conditions(mask, catalog: Dict, found: list):
+    # Collect (column, op, value) from df['col'] <op> constant terms joined with &
+    if isinstance(mask, ast.BinOp) and isinstance(mask.op, ast.BitAnd):
+        return _conditions(mask.left, catalog, found) and _conditions(mask.right, catalog, found)
+    if isinstance(mask, ast.Compare) and len(mask.ops) == 1:
+        name = _column(mask.left, catalog)
+        value = _constant(mask.comparators[0])
+        if name is not None and isinstance(value, (int, float, str)):
+            found.append((name, type(mask.ops[0]), value))
+            return True
+    return False
+
+def _overlaps(zone: dict, stats: dict, op, value) -> bool:
+    if not zone["has_value"]:
+        # Missing values never satisfy a comparison
+        return op is ast.NotEq
+    if stats["numeric"] and isinstance(value, (int, float)):
+        low, high = zone["num_min"], zone["num_max"]
+        if zone["has_float"]:
+            # pandas may parse a value one ulp away from float(); never prune at the boundary
+            low, high = math.nextafter(low, -math.inf), math.nextafter(high, math.inf)
+    elif not stats["numeric"] and isinstance(value, str):
+        low, high = zone["str_min"], zone["str_max"]
+    else:
+        return True
+    if op is ast.Eq:
+        return low <= value <= high
+    if op is ast.Gt:
+        return high > value
+    if op is ast.GtE:
+        return high >= value
+    if op is ast.Lt:
+        return low < value
+    if op is ast.LtE:
+        return low <= value
+    return True
+
+def prune_row_groups(code: str, catalog: Optional[Dict]) -> Optional[List[int]]:
+    """Return the row groups a filtered snippet can touch, or None when it may read all of df."""
+    if not catalog or not catalog["row_groups"]:
+        return None
+    try:
+        tree = ast.parse(code)
+    except SyntaxError:
+        return None
+    # df uses inside except handlers only run on errors, which fall back to the profile output
+    handlers = {id(node) for handler in ast.walk(tree) if isinstance(handler, ast.ExceptHandler)
+                for node in ast.walk(handler)}
+    filters = []
+    covered = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Subscript) and _is_df(node.value) and id(node) not in handlers:
+            found = []
+            if _conditions(_slice_value(node.slice), catalog, found):
+                filters.append(found)
+                covered.update(id(n) for n in ast.walk(node) if _is_df(n))
+    uses = [node for node in ast.walk(tree) if _is_df(node) and id(node) not in handlers]
+    if not filters or any(id(node) not in covered for node in uses):
+        return None
+    keep = []
+    for index, group in enumerate(catalog["row_groups"]):
+        for found in filters:
+            if all(_overlaps(group["zones"][name], catalog["columns"][name], op, value) for name, op, value in found):
+                keep.append(index)
+                break
+    # Pruning must not change the dtype pandas infers for any column (e.g. int64 vs float64)
+    for name, stats in catalog["columns"].items():
+        if _kind([catalog["row_groups"][i]["zones"][name] for i in keep]) != stats["kind"]:
+            return None
+    if len(keep) == len(catalog["row_groups"]):
+        return None
+    return keep
+
+def row_ranges(catalog: Dict, row_groups: List[int]) -> List[List[int]]:
+    """[first row number, row count] of each selected row group in the full file."""
+    return [[catalog["row_groups"][i]["start"], catalog["row_groups"][i]["rows"]] for i in row_groups]
+
+def restore_index_code(ranges: List[List[int]]) -> str:
+    """Script line giving a pruned df the row labels it would have in the full file."""
+    return (
+        "df.index = pd.Index([i for start, rows in "
+        f"{ranges!r} for i in range(start, start + rows)], dtype='int64')\n"
+    )
+
+def write_pruned_csv(file_path: str, catalog: Dict, row_groups: List[int], dest_path: str):
+    """Copy the header and the selected row groups' byte ranges into dest_path."""
+    with open(file_path, "rb") as src, open(dest_path, "wb") as dest:
+        dest.write(src.read(catalog["header_end"]))
+        for index in row_groups:
+            group = catalog["row_groups"][index]
+            src.seek(group["offset"])
+            dest.write(src.read(group["end"] - group["offset"]))
+    return dest_path
@@ -0,0 +1,191 @@
+import contextlib
+import io
+import json
+import os
+import subprocess
+import threading
+import time
+
+import pytest
+
+pytest.importorskip("fastapi")
+pytest.importorskip("docker")
+
+from services.code_sandbox_mcp import main as sandbox
+
+
+def run_capture(code, tmp_path, data):
+    # Same query script layout run_code_in_sandbox writes when a result path is requested
+    pd = pytest.importorskip("pandas")
+    pytest.importorskip("pyarrow")
+    assigned, capture_printed = sandbox.capture_plan(code)
+    script = (
+        sandbox.CAPTURE_PREAMBLE + code
+        + f"\n_assigned = {assigned!r}\n_capture_printed = {capture_printed!r}\n"
+        + sandbox.CAPTURE_EPILOGUE
+    )
+    cwd = os.getcwd()
+    os.chdir(tmp_path)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            exec(script, {"pd": pd, "df": pd.DataFrame(data)})
+    finally:
+        os.chdir(cwd)
+    meta = tmp_path / "result.json"
+    return json.loads(meta.read_text()) if meta.exists() else None
+
+
+DATA = {"year": [2022, 2023, 2023, 2023, 2023, 2023, 2023, 2023], "sales": list(range(8))}
+
+
+def test_capture_keeps_assigned_frame_not_printed_head(tmp_path):
+    meta = run_capture("filtered = df[df['year'] == 2023]\nprint(filtered.head(2))", tmp_path, DATA)
+    assert meta == {"kind": "frame", "columns": ["year", "sales"], "rows": 7}
+
+
+def test_capture_falls_back_to_printed_result(tmp_path):
+    meta = run_capture("print(df.groupby('year')['sales'].sum())", tmp_path, DATA)
+    assert meta == {"kind": "series", "columns": ["sales"], "rows": 2}
+
+
+def test_capture_skips_printed_previews(tmp_path):
+    assert run_capture("print(df[df['year'] == 2023].head())", tmp_path, DATA) is None
+
+
+def test_capture_plan_ignores_df_and_prev_names():
+    code = "try:\n    df = df[df['a'] > 1]\n    prev_2 = 1\n    x, y = df, df['a']\nexcept Exception:\n    pass"
+    assert sandbox.capture_plan(code) == (["x", "y"], True)
+
+
+def run_scaled(code, data, scale_factor):
+    pd = pytest.importorskip("pandas")
+    script = f"_SCALE = {scale_factor!r}\n" + sandbox.SCALE_PREAMBLE + sandbox.scale_aggregates(code)
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        exec(script, {"pd": pd, "df": pd.DataFrame(data)})
+    return out.getvalue().strip()
+
+
+@pytest.mark.parametrize("code, expected", [
+    ("print(len(df))", "80"),
+    ("print(df.shape[0])", "80"),
+    ("print(df['sales'].sum())", "280"),
+    ("print((df['year'] == 2023).sum())", "70"),
+    ("print(df['sales'].mean())", "3.5"),
+    ("print(df['sales'].sum() / len(df))", "3.5"),
+    ("print(df.count().sum())", "160"),
+    ("print(len(df['year'].value_counts()))", "2"),
+    ("print(df['year'].value_counts(normalize=True)[2022])", "0.125"),
+    ("print(df['year'].value_counts()[2023])", "70"),
+    ("print(df['sales'].max())", "7"),
+])
+def test_preview_scales_counts_and_sums_only(code, expected):
+    assert run_scaled(code, DATA, 10.0) == expected
+
+
+def test_scale_aggregates_leaves_unparseable_code_alone():
+    assert sandbox.scale_aggregates("print(len(df)") == "print(len(df)"
+
+
+def test_admission_is_first_come_first_served(monkeypatch):
+    monkeypatch.setattr(sandbox, "HOST_MEMORY_BUDGET_MB", 100)
+    assert sandbox.acquire_memory(60, timeout=1)
+    admitted = []
+
+    def waiter(memory_mb):
+        if sandbox.acquire_memory(memory_mb, timeout=5):
+            admitted.append(memory_mb)
+
+    large = threading.Thread(target=waiter, args=(100,))
+    large.start()
+    time.sleep(0.1)
+    # 30 MB would fit next to the running 60 MB, but the 100 MB run is waiting ahead of it
+    small = threading.Thread(target=waiter, args=(30,))
+    small.start()
+    time.sleep(0.1)
+    assert admitted == []
+    sandbox.release_memory(60)
+    large.join()
+    assert admitted == [100]
+    sandbox.release_memory(100)
+    small.join()
+    sandbox.release_memory(30)
+    assert admitted == [100, 30]
+
+
+def fake_docker(monkeypatch, returncode, stdout="", stderr=""):
+    # Replace docker with a canned result; returns the list of commands it was given
+    commands = []
+
+    def run(cmd, **kwargs):
+        commands.append(cmd)
+        return subprocess.CompletedProcess(cmd, returncode, stdout, stderr)
+
+    monkeypatch.setattr(subprocess, "run", run)
+    return commands
+
+
+def run_query(tmp_path, code="print(len(df))"):
+    path = tmp_path / "data.csv"
+    path.write_text("a\n1\n2\n")
+    return sandbox.run_code_in_sandbox(code, file_path=str(path))
+
+
+def test_missing_sandbox_image_is_a_structured_error(monkeypatch, tmp_path):
+    fake_docker(monkeypatch, 125, stderr=(
+        "Unable to find image 'data-agent-sandbox:latest' locally\n"
+        "docker: Error response from daemon: pull access denied for data-agent-sandbox, "
+        "repository does not exist or may require 'docker login'."
+    ))
+    result = run_query(tmp_path)
+    assert result["error"] == "sandbox_image_missing" and not result["success"]
+    assert "Dockerfile.sandbox" in result["stderr"]
+    assert sandbox._committed_memory_mb == 0
+
+
+@pytest.mark.parametrize("size_mb, code, expected", [
+    (1, "print(len(df))", "small"),
+    (300, "print(len(df))", "medium"),
+    (300, "print(df.groupby('a').sum())", "large"),
+    (5000, "print(len(df))", "large"),
+])
+def test_resource_profile_follows_size_and_code_cost(size_mb, code, expected):
+    assert sandbox.choose_resource_profile(size_mb * 1024 * 1024, code) == expected
+
+
+def test_admission_stays_under_budget_and_times_out(monkeypatch):
+    monkeypatch.setattr(sandbox, "HOST_MEMORY_BUDGET_MB", 100)
+    assert sandbox.acquire_memory(70, timeout=1)
+    assert not sandbox.acquire_memory(40, timeout=0.1)
+    assert sandbox.acquire_memory(30, timeout=0.1)
+    sandbox.release_memory(70)
+    assert sandbox.acquire_memory(40, timeout=0.1)
+    sandbox.release_memory(30)
+    sandbox.release_memory(40)
+    assert sandbox._committed_memory_mb == 0
+
+
+def test_memory_limit_is_capped_at_the_budget(monkeypatch, tmp_path):
+    monkeypatch.setattr(sandbox, "HOST_MEMORY_BUDGET_MB", 256)
+    commands = fake_docker(monkeypatch, 0, stdout="2\n")
+    result = run_query(tmp_path)
+    assert result["success"] and result["resource_profile"] == "small"
+    cmd = commands[0]
+    assert cmd[cmd.index("--memory") + 1] == "256m"
+    assert cmd[cmd.index("--network") + 1] == "none"
+    assert sandbox._committed_memory_mb == 0
+
+
+def test_busy_sandbox_rejects_admission(monkeypatch, tmp_path):
+    commands = fake_docker(monkeypatch, 0)
+    monkeypatch.setattr(sandbox, "acquire_memory", lambda memory_mb, timeout=None: False)
+    result = run_query(tmp_path)
+    assert result["error"] == "admission_rejected" and commands == []
+
+
+def test_exit_137_is_reported_as_oom(monkeypatch, tmp_path):
+    fake_docker(monkeypatch, sandbox.OOM_EXIT_CODE, stdout="partial")
+    result = run_query(tmp_path)
+    assert result["error"] == "oom" and not result["success"]
+    assert "memory limit" in result["stderr"]
+    assert sandbox._committed_memory_mb == 0
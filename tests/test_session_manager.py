@@ -0,0 +1,65 @@
+import os
+
+import pytest
+
+from services.session_manager import session_manager
+
+
+@pytest.fixture
+def session(tmp_path):
+    session_id = session_manager.create_session()
+    session_manager.sessions[session_id]["file_path"] = str(tmp_path / "input.csv")
+    yield session_id
+    session_manager.sessions.pop(session_id, None)
+
+
+def save_result_of_size(session_id, size, query="q"):
+    path = session_manager.new_intermediate_path(session_id)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    meta = {"kind": "frame", "columns": ["a"], "rows": 1}
+    return session_manager.save_intermediate(session_id, path, meta, query, "code"), path
+
+
+def test_intermediates_are_evicted_oldest_first_over_budget(monkeypatch, session):
+    monkeypatch.setattr(session_manager, "INTERMEDIATE_BUDGET_BYTES", 250)
+    first, first_path = save_result_of_size(session, 100, "first")
+    second, _ = save_result_of_size(session, 100, "second")
+    assert (first, second) == ("prev_1", "prev_2")
+    third, _ = save_result_of_size(session, 100, "third")
+    assert third == "prev_3"
+    assert [i["name"] for i in session_manager.get_intermediates(session)] == ["prev_2", "prev_3"]
+    assert not os.path.exists(first_path)
+    # History keeps every question, including the one whose result was evicted
+    assert [e["intermediate"] for e in session_manager.get_history(session)] == ["prev_1", "prev_2", "prev_3"]
+
+
+def test_result_larger_than_budget_is_not_kept(monkeypatch, session):
+    monkeypatch.setattr(session_manager, "INTERMEDIATE_BUDGET_BYTES", 250)
+    name, path = save_result_of_size(session, 300)
+    assert name is None
+    assert session_manager.get_intermediates(session) == []
+    assert not os.path.exists(path)
+
+
+def test_ingest_builds_an_ordered_reservoir_sample(session, tmp_path):
+    pd = pytest.importorskip("pandas")
+    rows = [f'{i},"note\n{i}"' for i in range(1000)]
+    (tmp_path / "input.csv").write_text("id,note\n" + "\n".join(rows) + "\n", encoding="utf-8")
+    session_manager.ingest_file(session, sample_size=50)
+    sample = session_manager.get_sample(session)
+    assert (sample["rows"], sample["total_rows"]) == (50, 1000)
+    assert session_manager.get_catalog(session)["rows"] == 1000
+    ids = pd.read_csv(sample["file_path"])["id"].tolist()
+    # Distinct rows kept in file order, drawn from the whole file rather than its head
+    assert len(set(ids)) == 50 and ids == sorted(ids)
+    assert max(ids) >= 50
+    assert pd.read_csv(sample["file_path"])["note"].tolist() == [f"note\n{i}" for i in ids]
+
+
+def test_small_upload_is_its_own_sample(session, tmp_path):
+    (tmp_path / "input.csv").write_text("id\n1\n2\n3\n", encoding="utf-8")
+    session_manager.ingest_file(session, sample_size=50)
+    assert session_manager.get_sample(session) == {
+        "file_path": str(tmp_path / "input.csv"), "rows": 3, "total_rows": 3
+    }
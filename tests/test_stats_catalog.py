@@ -0,0 +1,182 @@
+import contextlib
+import io
+
+import pytest
+
+pd = pytest.importorskip("pandas")
+
+from services.stats_catalog.stats_catalog import (
+    answer_from_catalog, build_catalog, prune_row_groups, restore_index_code, row_ranges, write_pruned_csv
+)
+
+
+def run_pandas(code, path, ranges=None):
+    # Same script layout run_code_in_sandbox writes for query mode
+    script = f"import pandas as pd\ndf = pd.read_csv({str(path)!r})\n"
+    if ranges:
+        script += restore_index_code(ranges)
+    out = io.StringIO()
+    with contextlib.redirect_stdout(out):
+        exec(script + code, {})
+    return out.getvalue().strip()
+
+
+def write_csv(tmp_path, text, name="data.csv"):
+    path = tmp_path / name
+    path.write_text(text, encoding="utf-8")
+    return path
+
+
+@pytest.fixture
+def mixed_csv(tmp_path):
+    # Three 40-row groups (one per year); every group has a missing 'sales' value
+    rows = ["year,region,qty,sales,price,missing,flag,note"]
+    for i in range(120):
+        sales = "NA" if i % 40 == 7 else str(i * 3 % 17)
+        note = '"multi\nline, quoted"' if i % 25 == 0 else f"n{i % 4}"
+        rows.append(f"{2020 + i // 40},{['EU', 'US', 'APAC'][i % 3]},{i % 7},{sales},{i / 4},,{i % 2 == 0},{note}")
+    return write_csv(tmp_path, "\n".join(rows) + "\n")
+
+
+@pytest.mark.parametrize("code", [
+    "print(len(df))",
+    "print(df.shape[0])",
+    "print(df['year'].sum())",
+    "print(df['year'].max())",
+    "print(df['year'].mean())",
+    "print(df['year'].nunique())",
+    "print(df['qty'].sum())",
+    "print(df['qty'].min())",
+    "print(df['sales'].count())",
+    "print(df['price'].count())",
+    "print(df.region.max())",
+    "print(df['region'].nunique())",
+    "print(df['note'].count())",
+    "print(df['region'].value_counts())",
+    "print(df['year'].value_counts())",
+    "print(df['qty'].value_counts().head(5))",
+    "print(df['qty'].value_counts().nlargest(3))",
+    "print(df['note'].value_counts().nlargest(2))",
+    "try:\n    print(df['region'].value_counts().head(2))\nexcept Exception as e:\n    print(len(df))",
+])
+def test_catalog_answers_match_pandas(mixed_csv, code):
+    catalog = build_catalog(str(mixed_csv), row_group_size=40)
+    answer = answer_from_catalog(code, catalog)
+    assert answer is not None
+    assert answer == run_pandas(code, mixed_csv)
+
+
+@pytest.mark.parametrize("code", [
+    "print(df['flag'].max())",
+    "print(df['price'].value_counts())",
+    "print(df['price'].value_counts().head(3))",
+    "print(df['price'].sum())",
+    "print(df['price'].mean())",
+    "print(df['price'].max())",
+    "print(df['price'].nunique())",
+    "print(df['sales'].sum())",
+    "print(df['sales'].max())",
+    "print(df['sales'].value_counts())",
+    "print(df['region'].sum())",
+    "print(df['missing'].max())",
+    "print(df['sales'].max() + 1)",
+    "print(df[df['year'] == 2021]['sales'].sum())",
+])
+def test_catalog_declines_snippets_it_cannot_reproduce(mixed_csv, code):
+    catalog = build_catalog(str(mixed_csv), row_group_size=40)
+    assert answer_from_catalog(code, catalog) is None
+
+
+def test_value_counts_over_display_limit_needs_scan(tmp_path):
+    path = write_csv(tmp_path, "id\n" + "".join(f"{i}\n" for i in range(100)))
+    catalog = build_catalog(str(path))
+    assert answer_from_catalog("print(df['id'].value_counts())", catalog) is None
+    code = "print(df['id'].value_counts().head(5))"
+    assert answer_from_catalog(code, catalog) == run_pandas(code, path)
+
+
+def test_na_strings_are_missing(tmp_path):
+    path = write_csv(tmp_path, "v,w\n1,a\nNA,null\n3,\nnull,b\n")
+    catalog = build_catalog(str(path))
+    for code in ["print(df['v'].count())", "print(df['w'].count())", "print(df['w'].nunique())"]:
+        assert answer_from_catalog(code, catalog) == run_pandas(code, path)
+    # NAs make 'v' float64, so its aggregates go to the sandbox
+    assert answer_from_catalog("print(df['v'].sum())", catalog) is None
+
+
+def test_float_columns_are_not_answered_from_catalog(tmp_path):
+    # float() and pandas' parser disagree on some of these; the catalog must not claim them
+    values = [f"{(i * 7919 % 100000) / 97.3:.13f}" for i in range(5000)]
+    path = write_csv(tmp_path, "x\n" + "\n".join(values) + "\n")
+    catalog = build_catalog(str(path))
+    for agg in ("sum", "mean", "max", "min", "nunique"):
+        assert answer_from_catalog(f"print(df['x'].{agg}())", catalog) is None
+    code = "print(df['x'].count())"
+    assert answer_from_catalog(code, catalog) == run_pandas(code, path)
+
+
+def test_float_zone_bounds_are_not_pruned_at_the_boundary(tmp_path):
+    path = write_csv(tmp_path, "x\n" + "".join(f"{i / 3}\n" for i in range(120)))
+    catalog = build_catalog(str(path), row_group_size=40)
+    zone_max = catalog["row_groups"][0]["zones"]["x"]["num_max"]
+    # A strict filter exactly at a float zone's max keeps that zone
+    code = f"print(df[df['x'] > {zone_max!r}]['x'].count())"
+    keep = prune_row_groups(code, catalog)
+    assert keep is None or 0 in keep
+
+
+def test_multiline_quoted_fields_keep_row_counts(tmp_path):
+    path = write_csv(tmp_path, 'a,b\n1,"x\ny"\n2,"p,\n\nq"\n\n3,z\n')
+    catalog = build_catalog(str(path), row_group_size=2)
+    assert catalog["rows"] == len(pd.read_csv(path))
+    assert [group["rows"] for group in catalog["row_groups"]] == [2, 1]
+
+
+@pytest.mark.parametrize("code", [
+    "print(df[df['year'] == 2022]['price'].sum())",
+    "print(df[df['year'] == 2022]['price'].idxmax())",
+    "print(df[df['year'] >= 2021]['price'].idxmin())",
+    "print(df[(df['year'] == 2020) & (df['region'] == 'EU')].index.tolist())",
+    "print(df[df['year'] == 2022].head())",
+    "print(df[df['year'] < 2021]['note'].value_counts())",
+])
+def test_pruned_runs_match_full_runs(mixed_csv, tmp_path, code):
+    catalog = build_catalog(str(mixed_csv), row_group_size=40)
+    keep = prune_row_groups(code, catalog)
+    assert keep is not None and len(keep) < len(catalog["row_groups"])
+    pruned = write_pruned_csv(str(mixed_csv), catalog, keep, str(tmp_path / "pruned.csv"))
+    assert run_pandas(code, pruned, row_ranges(catalog, keep)) == run_pandas(code, mixed_csv)
+
+
+def test_pruning_skipped_when_dtype_would_change(tmp_path):
+    # 'sales' has its only NA in the first group: float64 in full, int64 without that group
+    path = write_csv(tmp_path, "year,sales\n" + "".join(
+        f"{2020 + i // 40},{'NA' if i == 7 else i}\n" for i in range(120)
+    ))
+    catalog = build_catalog(str(path), row_group_size=40)
+    assert catalog["columns"]["sales"]["kind"] == "float"
+    assert prune_row_groups("print(df[df['year'] == 2021]['sales'].sum())", catalog) is None
+    # Restricting to the group that holds the NA keeps float64, so that one may prune
+    assert prune_row_groups("print(df[df['year'] == 2020]['sales'].sum())", catalog) == [0]
+
+
+@pytest.mark.parametrize("code", [
+    "print(len(df))",
+    "print(df[df['year'] == 2022]['price'].sum(), df['price'].sum())",
+    "x = df[df['year'] == 2022]\ndf = x\nprint(len(df))",
+    "print(df.loc[df['year'] == 2022, 'price'].sum())",
+])
+def test_pruning_skipped_when_df_is_read_unfiltered(mixed_csv, code):
+    catalog = build_catalog(str(mixed_csv), row_group_size=40)
+    assert prune_row_groups(code, catalog) is None
+
+
+def test_dataframe_attributes_are_not_columns(tmp_path):
+    path = write_csv(tmp_path, "values,size,year\n" + "".join(f"{i},{i * 2},{2020 + i // 40}\n" for i in range(120)))
+    catalog = build_catalog(str(path), row_group_size=40)
+    assert answer_from_catalog("print(df.values.max())", catalog) is None
+    assert answer_from_catalog("print(df.size.sum())", catalog) is None
+    code = "print(df['values'].max())"
+    assert answer_from_catalog(code, catalog) == run_pandas(code, path)
+    assert prune_row_groups("print(df[df.size > 200]['year'].sum())", catalog) is None
+    assert prune_row_groups("print(df[df.year == 2022]['values'].sum())", catalog) == [2]
@@ -29,14 +29,17 @@ if session_id:
         st.subheader("Columns")
         st.write(columns)
     user_query = st.text_input("Your question:")
+    preview = st.checkbox("Fast preview (approximate, on a sample)")
     if user_query:
         if st.button("Ask"):
-            data = {"session_id": session_id, "query": user_query}
+            data = {"session_id": session_id, "query": user_query, "mode": "preview" if preview else "exact"}
             resp = requests.post("http://localhost:9000/ask", data=data)
             if resp.status_code == 200:
                 result = resp.json()
-                st.subheader("Answer")
+                st.subheader("Answer (approximate preview)" if result.get("approximate") else "Answer")
                 st.write(result.get("answer", "No answer returned."))
+                if result.get("job_id"):
+                    st.session_state["job_id"] = result["job_id"]
                 st.subheader("Pandas Code")
                 st.code(result.get("pandas_code", ""), language="python")
                 if result.get("sandbox_output"):
@@ -44,3 +47,22 @@ if session_id:
                     st.text(result["sandbox_output"])
             else:
                 st.error(f"Error: {resp.text}")
+
+if session_id and st.session_state.get("job_id"):
+    if st.button("Get exact answer"):
+        params = {"session_id": session_id, "job_id": st.session_state["job_id"]}
+        resp = requests.get("http://localhost:9000/ask/result", params=params)
+        if resp.status_code == 200:
+            result = resp.json()
+            if result.get("status") == "done":
+                st.subheader("Answer")
+                st.write(result.get("answer", "No answer returned."))
+            elif result.get("status") == "failed":
+                st.error(f"Exact run failed: {result.get('error')}")
+                if result.get("sandbox_output"):
+                    st.subheader("Sandbox Output")
+                    st.text(result["sandbox_output"])
+            else:
+                st.info("Exact answer is still running.")
+        else:
+            st.error(f"Error: {resp.text}")